@@ -5,7 +5,7 @@
 Nacos Service Discovery Scheduler
 
 This script schedules and runs the Nacos service discovery process periodically.
-It uses the schedule library to run the discovery process every 10 seconds,
+It uses a monotonic-clock loop to run the discovery process every 10 seconds,
 ensuring that the Prometheus configuration stays up to date with the services
 registered in Nacos.
 
@@ -14,7 +14,7 @@ Date: 2024-12-20
 """
 
 import logging
-import schedule
+import random
 import signal
 import sys
 import time
@@ -29,6 +29,11 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 服务发现任务的执行间隔（秒）
+INTERVAL_SECONDS = 10
+# 每次等待时间的随机抖动范围（秒），避免多个实例同时请求 Nacos
+JITTER_SECONDS = 1.0
+
 def signal_handler(signum: int, frame) -> None:
     """
     处理进程信号，确保程序优雅退出
@@ -47,34 +52,52 @@ def discovery_job() -> None:
     捕获并记录任务执行过程中的任何异常，确保调度器继续运行
     """
     try:
-        logger.info("开始执行服务发现任务")
+        logger.debug("开始执行服务发现任务")
         nacos_discovery.main()
-        logger.info("服务发现任务执行完成")
+        logger.debug("服务发现任务执行完成")
     except Exception as e:
         logger.error(f"服务发现任务执行失败: {str(e)}", exc_info=True)
 
+def warm_up() -> None:
+    """
+    启动时预先创建共享客户端并完成认证
+    
+    后续周期依赖令牌有效期按需刷新；此处认证失败不会中断启动，
+    首次执行任务时会再次尝试认证
+    """
+    try:
+        nacos_discovery.get_client().authenticate()
+    except Exception as e:
+        logger.error(f"启动时认证失败，将在执行任务时重试: {str(e)}")
+
 def run_scheduler() -> NoReturn:
     """
     运行调度器，定期执行服务发现任务
     
-    每10秒执行一次服务发现任务，并处理键盘中断信号
+    每10秒执行一次服务发现任务，并处理键盘中断信号。
+    基于单调时钟计算下一次执行时间，不受系统时间调整影响；
+    任务执行超时时跳过错过的周期，而不是连续补跑。
+    每次等待叠加随机抖动，抖动不会累积到后续周期。
     """
     # 注册信号处理器
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     
-    # 设置调度任务
-    schedule.every(10).seconds.do(discovery_job)
-    logger.info("服务发现调度器已启动，每10秒执行一次")
+    logger.info(f"服务发现调度器已启动，每{INTERVAL_SECONDS}秒执行一次")
     
     try:
-        # 立即执行一次任务
-        discovery_job()
+        warm_up()
         
-        # 持续运行调度器
+        # 立即执行一次任务，之后按固定间隔执行
+        next_run = time.monotonic()
         while True:
-            schedule.run_pending()
-            time.sleep(1)
+            discovery_job()
+            next_run += INTERVAL_SECONDS
+            now = time.monotonic()
+            while next_run <= now:
+                next_run += INTERVAL_SECONDS
+            jitter = random.uniform(-JITTER_SECONDS, JITTER_SECONDS)
+            time.sleep(max(0.0, next_run - now + jitter))
     except KeyboardInterrupt:
         logger.info("收到键盘中断信号，程序退出")
         sys.exit(0)
@@ -13,12 +13,16 @@ Date: 2024-12-20
 """
 
 import os
-import json
-import shutil
+import time
+import hashlib
 import logging
-from typing import List, Dict, Any
-import requests
-from requests.exceptions import RequestException
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Tuple
+import httpx
+import ijson
+import orjson
 
 # 配置日志
 logging.basicConfig(
@@ -26,6 +30,29 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+# httpx 会以 INFO 级别记录每个请求的完整 URL，其中包含 accessToken 查询参数，
+# 因此只保留其警告及以上级别的日志，避免令牌泄露到日志中
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# 并发拉取服务实例的最大线程数
+MAX_WORKERS = 16
+# HTTP 长连接池大小，需不小于并发线程数，避免并发时连接被丢弃后重新握手
+POOL_SIZE = 32
+# HTTP 最大连接数、空闲长连接保持时间及请求超时时间（秒）
+MAX_CONNECTIONS = 64
+KEEPALIVE_EXPIRY = 30.0
+HTTP_TIMEOUT = 5.0
+# 网关类错误的重试次数、退避基数（秒）及需要重试的状态码
+RETRY_TOTAL = 2
+RETRY_BACKOFF = 0.2
+RETRY_STATUSES = (502, 503, 504)
+# 服务端未返回 tokenTtl 时使用的默认令牌有效期（秒），以及提前刷新的安全余量
+DEFAULT_TOKEN_TTL = 18000
+TOKEN_REFRESH_MARGIN = 60
+# 分页获取服务列表时的每页大小
+SERVICE_PAGE_SIZE = 500
+# Prometheus 读取的目标配置文件名
+CONFIG_FILENAME = "services.json"
 
 class NacosConfig:
     """Nacos 配置类，存储所有 Nacos 相关的配置参数"""
@@ -36,7 +63,46 @@ class NacosConfig:
         self.username = os.getenv("NACOS_USERNAME", "nacos")
         self.password = os.getenv("NACOS_PASSWORD", "nacos")
         self.group_name = os.getenv("GROUP_NAME", "DEFAULT_GROUP")
+        # 服务实例缓存有效期（秒），为 0 时每次都重新拉取
+        self.instance_cache_ttl = float(os.getenv("INSTANCE_CACHE_TTL", "30"))
         self.token = ""
+        self.token_expiry = 0.0
+
+def _describe_error(error: Exception) -> str:
+    """
+    生成可写入日志的错误描述，去除请求 URL 中的访问令牌
+    
+    Args:
+        error: 请求过程中抛出的异常
+        
+    Returns:
+        str: 错误描述
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        url = error.request.url.copy_remove_param("accessToken")
+        return f"{error.response.status_code} {error.response.reason_phrase} for url '{url}'"
+    return str(error)
+
+def _iter_hosts(chunks: Iterable[bytes]) -> Iterator[Dict[str, Any]]:
+    """
+    将响应体分块推送给 ijson，逐个产出 hosts 中的实例
+    
+    各数据块直接交给解析器，不再拼接或切片缓冲，响应体不会整体驻留内存。
+    
+    Args:
+        chunks: 响应体数据块
+        
+    Yields:
+        Dict: Nacos 服务实例
+    """
+    hosts = ijson.sendable_list()
+    parser = ijson.items_coro(hosts, 'hosts.item')
+    for chunk in chunks:
+        parser.send(chunk)
+        yield from hosts
+        del hosts[:]
+    parser.close()
+    yield from hosts
 
 class NacosClient:
     """Nacos 客户端类，处理与 Nacos 服务器的所有交互"""
@@ -49,14 +115,30 @@ class NacosClient:
             config: NacosConfig 实例，包含所有必要的配置参数
         """
         self.config = config
-        self.session = requests.Session()
+        # 线程安全的连接池客户端，跨调度周期复用长连接；传输层在连接失败时自动重试。
+        # 经 TLS 访问支持 HTTP/2 的网关时，所有并发请求复用同一连接的多路复用流
+        limits = httpx.Limits(
+            max_keepalive_connections=POOL_SIZE,
+            max_connections=MAX_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY
+        )
+        self.session = httpx.Client(
+            transport=httpx.HTTPTransport(http2=True, limits=limits, retries=RETRY_TOTAL),
+            timeout=HTTP_TIMEOUT
+        )
+        self._auth_lock = threading.Lock()
+        # 服务名 -> (拉取时间, 目标配置列表)
+        self._target_cache: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+        # 累计下载的响应体字节数，用于统计每个周期的流量
+        self.bytes_downloaded = 0
+        self._stats_lock = threading.Lock()
 
     def authenticate(self) -> None:
         """
         获取 Nacos 的访问令牌
         
         Raises:
-            RequestException: 当认证请求失败时抛出
+            httpx.HTTPError: 当认证请求失败时抛出
         """
         auth_url = f"{self.config.server}/nacos/v1/auth/login"
         auth_data = {
@@ -66,152 +148,363 @@ class NacosClient:
         
         try:
             response = self.session.post(auth_url, data=auth_data)
+            self._record_download(response)
             response.raise_for_status()
-            self.config.token = response.json().get("accessToken")
+            result = orjson.loads(response.content)
+            self.config.token = result.get("accessToken")
             if not self.config.token:
                 raise ValueError("Failed to retrieve access token")
+            token_ttl = result.get("tokenTtl", DEFAULT_TOKEN_TTL)
+            self.config.token_expiry = time.monotonic() + token_ttl - TOKEN_REFRESH_MARGIN
             logger.info("Successfully authenticated with Nacos server")
-        except RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Authentication failed: {str(e)}")
             raise
 
-    def get_services(self) -> List[str]:
+    def ensure_authenticated(self) -> None:
+        """
+        在令牌缺失或即将过期时重新认证，否则复用已有令牌
+        """
+        with self._auth_lock:
+            if not self.config.token or time.monotonic() >= self.config.token_expiry:
+                self.authenticate()
+
+    def _send(self, url: str, params: Dict[str, Any], stream: bool) -> httpx.Response:
+        """
+        发送 GET 请求，遇到网关类错误 (502/503/504) 时按指数退避重试
+        
+        除调用方负责读取的流式响应外，收到的每个响应（包括重试前丢弃的）都计入下载字节数。
+        
+        Args:
+            url: 请求地址
+            params: 查询参数
+            stream: 是否以流式方式读取响应体
+            
+        Returns:
+            httpx.Response: 响应对象
+        """
+        request = self.session.build_request("GET", url, params=params)
+        for attempt in range(RETRY_TOTAL):
+            response = self.session.send(request, stream=stream)
+            if response.status_code not in RETRY_STATUSES:
+                break
+            response.close()
+            self._record_download(response)
+            time.sleep(RETRY_BACKOFF * 2 ** attempt)
+        else:
+            # 最后一次尝试无论状态码如何都直接返回
+            response = self.session.send(request, stream=stream)
+        if not stream:
+            self._record_download(response)
+        return response
+
+    def _authed_get(self, url: str, params: Dict[str, Any], stream: bool = False) -> httpx.Response:
+        """
+        携带访问令牌发送 GET 请求，令牌被拒绝 (401/403) 时重新认证并重试一次
+        
+        Args:
+            url: 请求地址
+            params: 查询参数（不含 accessToken）
+            stream: 是否以流式方式读取响应体，调用方负责关闭响应
+            
+        Returns:
+            httpx.Response: 响应对象
+        """
+        self.ensure_authenticated()
+        token = self.config.token
+        response = self._send(url, {**params, "accessToken": token}, stream)
+        if response.status_code in (401, 403):
+            response.close()
+            if stream:
+                self._record_download(response)
+            with self._auth_lock:
+                # 其他线程可能已刷新令牌，仅在令牌未变化时重新认证
+                if self.config.token == token:
+                    self.config.token = ""
+                    self.authenticate()
+            response = self._send(url, {**params, "accessToken": self.config.token}, stream)
+        return response
+
+    def _record_download(self, response: httpx.Response) -> None:
+        """
+        累加响应体的下载字节数
+        
+        Args:
+            response: 已读取完毕或已关闭的响应对象
+        """
+        with self._stats_lock:
+            self.bytes_downloaded += response.num_bytes_downloaded
+
+    def get_services(self) -> Optional[List[str]]:
         """
         获取所有注册的服务列表
         
         Returns:
-            List[str]: 服务名称列表
+            Optional[List[str]]: 服务名称列表；任意一页获取失败时返回 None，
+            不返回不完整的列表，以便与“没有服务”区分
         """
+        services = []
+        page_no = 1
         try:
-            response = self.session.get(
-                f"{self.config.server}/nacos/v1/ns/service/list",
-                params={
-                    "namespaceId": self.config.namespace,
-                    "groupName": self.config.group_name,
-                    "pageNo": 1,
-                    "pageSize": 100,
-                    "accessToken": self.config.token
-                }
-            )
-            response.raise_for_status()
-            services = response.json().get('doms', [])
-            logger.info(f"Retrieved {len(services)} services")
+            # 逐页获取，直到返回不足一页或已达到服务总数
+            while True:
+                response = self._authed_get(
+                    f"{self.config.server}/nacos/v1/ns/service/list",
+                    params={
+                        "namespaceId": self.config.namespace,
+                        "groupName": self.config.group_name,
+                        "pageNo": page_no,
+                        "pageSize": SERVICE_PAGE_SIZE
+                    }
+                )
+                response.raise_for_status()
+                result = orjson.loads(response.content)
+                page = result.get('doms') or []
+                services.extend(page)
+                # 仅在服务端返回 count 时据此提前结束，否则依赖不足一页或空页判断
+                if len(page) < SERVICE_PAGE_SIZE or ('count' in result and len(services) >= result['count']):
+                    break
+                page_no += 1
+            logger.debug(f"Retrieved {len(services)} services")
             return services
-        except RequestException as e:
-            logger.error(f"Failed to fetch services: {str(e)}")
-            return []
+        except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+            logger.error(f"Failed to fetch services (page {page_no}): {_describe_error(e)}")
+            return None
 
-    def get_service_instances(self, service_name: str) -> List[Dict[str, Any]]:
+    def iter_targets(self, service_name: str) -> Iterator[Dict[str, Any]]:
         """
-        获取特定服务的所有实例
+        流式获取特定服务的实例，并直接逐个生成 Prometheus 目标配置
         
         Args:
             service_name: 服务名称
             
-        Returns:
-            List[Dict]: 服务实例列表
+        Yields:
+            Dict: Prometheus 目标配置
         """
+        response = self._authed_get(
+            f"{self.config.server}/nacos/v1/ns/instance/list",
+            params={
+                "namespaceId": self.config.namespace,
+                "serviceName": service_name,
+                "groupName": self.config.group_name,
+                "clusters": "",
+                "healthyOnly": False
+            },
+            stream=True
+        )
         try:
-            response = self.session.get(
-                f"{self.config.server}/nacos/v1/ns/instance/list",
-                params={
-                    "namespaceId": self.config.namespace,
-                    "serviceName": service_name,
-                    "groupName": self.config.group_name,
-                    "clusters": "",
-                    "healthyOnly": False,
-                    "accessToken": self.config.token
-                }
-            )
             response.raise_for_status()
-            instances = response.json().get('hosts', [])
-            logger.info(f"Retrieved {len(instances)} instances for service {service_name}")
-            return instances
-        except RequestException as e:
-            logger.error(f"Failed to fetch instances for {service_name}: {str(e)}")
-            return []
+            # 流式解析响应体，只逐个构建 hosts 中的实例，不生成完整的 JSON 树
+            instances = _iter_hosts(response.iter_bytes())
+            yield from PrometheusConfigGenerator.generate_target_config(instances, service_name)
+        finally:
+            response.close()
+            self._record_download(response)
+
+    def get_service_targets(self, service_name: str) -> List[Dict[str, Any]]:
+        """
+        获取特定服务的所有 Prometheus 目标配置，缓存未过期时直接返回缓存结果
+        
+        Args:
+            service_name: 服务名称
+            
+        Returns:
+            List[Dict]: Prometheus 目标配置列表；获取失败时返回过期的缓存结果，无缓存时返回空列表
+        """
+        cached = self._target_cache.get(service_name)
+        if cached is not None and time.monotonic() - cached[0] < self.config.instance_cache_ttl:
+            return cached[1]
+        
+        try:
+            fetched_at = time.monotonic()
+            targets = list(self.iter_targets(service_name))
+            self._target_cache[service_name] = (fetched_at, targets)
+            logger.debug(f"Retrieved {len(targets)} instances for service {service_name}")
+            return targets
+        except (httpx.HTTPError, ijson.JSONError) as e:
+            logger.error(f"Failed to fetch instances for {service_name}: {_describe_error(e)}")
+            # 短暂故障时沿用上一次的结果，避免该服务的目标从配置中消失
+            return cached[1] if cached is not None else []
+
+    def prune_cache(self, services: Iterable[str]) -> None:
+        """
+        清理已不存在的服务的实例缓存
+        
+        Args:
+            services: 当前注册的服务名称
+        """
+        active = set(services)
+        for service_name in list(self._target_cache):
+            if service_name not in active:
+                del self._target_cache[service_name]
+
+# 上一次写入的配置内容摘要，内容未变化时跳过写入，避免触发 Prometheus 重新加载
+_last_hash: Optional[bytes] = None
 
 class PrometheusConfigGenerator:
     """Prometheus 配置生成器，负责生成和管理 Prometheus 目标配置"""
 
     @staticmethod
-    def generate_target_config(instances: List[Dict[str, Any]], service_name: str) -> List[Dict[str, Any]]:
+    def generate_target_config(instances: Iterable[Dict[str, Any]], service_name: str) -> Iterator[Dict[str, Any]]:
         """
-        为服务实例生成 Prometheus 目标配置
+        为服务实例逐个生成 Prometheus 目标配置
         
         Args:
-            instances: 服务实例列表
+            instances: 服务实例迭代器
             service_name: 服务名称
             
-        Returns:
-            List[Dict]: Prometheus 目标配置列表
+        Yields:
+            Dict: Prometheus 目标配置
         """
-        targets = []
+        # 每个服务只构建一次标签模板，实例地址也只格式化一次
+        base_labels = {"instance": "", "job": "nacos-discovery", "service": service_name}
         for instance in instances:
             # 添加原始端口配置
-            targets.append({
-                "targets": [f"{instance['ip']}:{instance['port']}"],
-                "labels": {
-                    "instance": f"{instance['ip']}:{instance['port']}",
-                    "job": "nacos-discovery",
-                    "service": service_name
-                }
-            })
-        return targets
+            address = f"{instance['ip']}:{instance['port']}"
+            labels = base_labels.copy()
+            labels["instance"] = address
+            yield {"targets": [address], "labels": labels}
+
+    @staticmethod
+    def _iter_chunks(targets: Iterable[Dict[str, Any]], pretty: bool) -> Iterator[bytes]:
+        """
+        逐个序列化目标配置，产出组成完整 JSON 文档的字节块
+        
+        缩进格式下输出布局与 json.dump(targets, indent=2) 一致。
+        
+        Args:
+            targets: 目标配置
+            pretty: 是否以缩进格式输出
+            
+        Yields:
+            bytes: JSON 文档片段
+        """
+        if pretty:
+            opening, delimiter, closing = b"[\n  ", b",\n  ", b"\n]"
+        else:
+            opening, delimiter, closing = b"[", b",", b"]"
+        separator = opening
+        for target in targets:
+            yield separator
+            if pretty:
+                yield orjson.dumps(target, option=orjson.OPT_INDENT_2).replace(b"\n", b"\n  ")
+            else:
+                yield orjson.dumps(target)
+            separator = delimiter
+        yield b"[]" if separator is opening else closing
 
     @staticmethod
-    def save_config(targets: List[Dict[str, Any]], output_path: str, config_dir: str) -> None:
+    def save_config(targets: Iterable[Dict[str, Any]], config_dir: str, pretty: bool = False) -> bool:
         """
-        保存并复制 Prometheus 配置文件
+        保存 Prometheus 配置文件
+        
+        先计算内容摘要，与上一次写入的内容完全相同时直接返回，不在配置目录中产生任何文件事件；
+        否则写入 Prometheus 配置目录下的临时文件，再原子重命名为目标文件，
+        保证 Prometheus 不会读取到写了一半的配置。
         
         Args:
-            targets: 目标配置列表
-            output_path: 输出文件路径
+            targets: 目标配置
             config_dir: Prometheus 配置目录
+            pretty: 是否以缩进格式输出，默认输出紧凑 JSON
+            
+        Returns:
+            bool: 配置文件是否被更新
         """
+        global _last_hash
+        dest_path = os.path.join(config_dir, CONFIG_FILENAME)
+        # 需要先后遍历两次（计算摘要、写入文件），目标字典本身已由各服务的结果持有
+        targets = list(targets)
+        
+        # 逐块序列化计算摘要，不在内存中拼接完整文档
+        digest = hashlib.blake2b()
+        for chunk in PrometheusConfigGenerator._iter_chunks(targets, pretty):
+            digest.update(chunk)
+        content_hash = digest.digest()
+        if content_hash == _last_hash and os.path.exists(dest_path):
+            logger.debug("Configuration unchanged, skip writing")
+            return False
+        
+        tmp_path = None
         try:
             # 确保配置目录存在
             os.makedirs(config_dir, exist_ok=True)
             
-            # 写入配置文件
-            with open(output_path, 'w') as f:
-                json.dump(targets, f, indent=2)
-            logger.info(f"Configuration written to {output_path}")
-
-            # 复制到 Prometheus 配置目录
-            dest_path = os.path.join(config_dir, os.path.basename(output_path))
-            shutil.copy(output_path, dest_path)
-            logger.info(f"Configuration copied to {dest_path}")
+            with tempfile.NamedTemporaryFile('wb', dir=config_dir, suffix='.tmp', delete=False) as f:
+                tmp_path = f.name
+                for chunk in PrometheusConfigGenerator._iter_chunks(targets, pretty):
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            # NamedTemporaryFile 默认权限为 0600，放开读权限供 Prometheus 读取
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, dest_path)
+            tmp_path = None
+            logger.debug(f"Configuration written to {dest_path}")
+            _last_hash = content_hash
+            return True
         except (IOError, OSError) as e:
-            logger.error(f"Failed to save or copy configuration: {str(e)}")
+            logger.error(f"Failed to save configuration: {str(e)}")
             raise
+        finally:
+            # 写入过程中出现任何异常，都确保临时文件被清理
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+# 跨调度周期复用的客户端实例，首次调用 main() 时创建
+_client: Optional[NacosClient] = None
+
+def get_client() -> NacosClient:
+    """
+    获取模块级共享的 Nacos 客户端，首次调用时初始化
+    
+    Returns:
+        NacosClient: 共享的客户端实例
+    """
+    global _client
+    if _client is None:
+        _client = NacosClient(NacosConfig())
+    return _client
 
 def main():
     """主函数，协调整个服务发现和配置生成过程"""
+    started_at = time.monotonic()
     try:
-        # 初始化配置和客户端
-        config = NacosConfig()
-        client = NacosClient(config)
-        
-        # 认证
-        client.authenticate()
+        # 复用已有客户端，令牌在缺失或过期时才重新获取
+        client = get_client()
+        bytes_before = client.bytes_downloaded
+        client.ensure_authenticated()
         
         # 获取服务列表
         services = client.get_services()
+        if services is None:
+            # 服务列表获取失败时保留缓存和已发布的配置，等待下一个周期
+            logger.warning("Service list unavailable, keeping the last published configuration")
+            return
+        client.prune_cache(services)
         
-        # 收集所有目标
-        all_targets = []
-        for service_name in services:
-            instances = client.get_service_instances(service_name)
-            targets = PrometheusConfigGenerator.generate_target_config(instances, service_name)
-            all_targets.extend(targets)
-        
-        # 保存配置
-        output_path = './app/services.json'
+        # 并发拉取各服务的实例，并在解析时直接生成目标配置
         config_dir = './prometheus/conf'
-        PrometheusConfigGenerator.save_config(all_targets, output_path, config_dir)
+        pretty = os.getenv("PRETTY_JSON", "0") == "1"
+        target_count = 0
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            def iter_all_targets() -> Iterator[Dict[str, Any]]:
+                nonlocal target_count
+                for targets in executor.map(client.get_service_targets, services):
+                    target_count += len(targets)
+                    yield from targets
+            
+            # 按服务顺序汇总各服务的目标并保存配置
+            changed = PrometheusConfigGenerator.save_config(iter_all_targets(), config_dir, pretty)
         
-        logger.info("Service discovery and configuration generation completed successfully")
+        # 每个周期只输出一行汇总，配置未变化时降为 DEBUG 级别
+        elapsed_ms = (time.monotonic() - started_at) * 1000
+        outcome = f"written to {os.path.join(config_dir, CONFIG_FILENAME)}" if changed else "unchanged"
+        logger.log(
+            logging.INFO if changed else logging.DEBUG,
+            f"Discovery tick: {len(services)} services, {target_count} targets, "
+            f"{client.bytes_downloaded - bytes_before}B downloaded, {elapsed_ms:.1f}ms, "
+            f"configuration {outcome}"
+        )
     except Exception as e:
         logger.error(f"An error occurred during execution: {str(e)}")
         raise